@@ -22,9 +22,15 @@ def get_dataloader(files, config, args):
                                       pattern=args.pattern,
                                       orientation=args.orientation)
 
+    num_workers = config.data.num_workers
+    # prefetch_factor/persistent_workers are only valid with workers
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=2) if num_workers > 0 else {}
     loader = torch.utils.data.DataLoader(dataset=dataset,
                                          batch_size=config.batch_size,
                                          sampler=None,
-                                         shuffle=False)
+                                         shuffle=False,
+                                         num_workers=num_workers,
+                                         pin_memory=True,
+                                         **worker_kwargs)
 
     return loader
@@ -9,6 +9,7 @@ import h5py
 import numpy as np
 import sigpy as sp
 import torch
+from scipy.ndimage import uniform_filter
 import torch.distributed as dist
 import torch.fft as torch_fft
 import torchvision
@@ -225,6 +226,38 @@ def get_mvue(kspace, s_maps):
         np.sum(np.square(np.abs(s_maps)), axis=1))
 
 
+def batched_ssim(orig, recon, data_range=255., win_size=7, K1=0.01, K2=0.03):
+    ''' Vectorized SSIM over a (B, H, W) batch, matching skimage defaults '''
+    X = orig.astype(np.float64)
+    Y = recon.astype(np.float64)
+    size = (1,) * (X.ndim - 2) + (win_size, win_size)
+
+    NP = win_size ** 2
+    cov_norm = NP / (NP - 1)  # sample covariance, as in skimage
+    ux = uniform_filter(X, size=size)
+    uy = uniform_filter(Y, size=size)
+    uxx = uniform_filter(X * X, size=size)
+    uyy = uniform_filter(Y * Y, size=size)
+    uxy = uniform_filter(X * Y, size=size)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    C1 = (K1 * data_range) ** 2
+    C2 = (K2 * data_range) ** 2
+    S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux ** 2 + uy ** 2 + C1) * (vx + vy + C2))
+
+    # ignore the filter's edge effects, as skimage does
+    pad = (win_size - 1) // 2
+    return S[..., pad:-pad, pad:-pad].mean(axis=(-2, -1))
+
+
+def get_mvue_torch(kspace, s_maps):
+    ''' Get mvue estimate from coil measurements, staying on device '''
+    return torch.sum(ifft(kspace) * torch.conj(s_maps), dim=1) / torch.sqrt(
+        torch.sum(torch.square(torch.abs(s_maps)), dim=1))
+
+
 def loss_geocross(latent):
     if latent.size() == (1, 512):
         return 0
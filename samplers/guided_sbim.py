@@ -1,5 +1,7 @@
 import json
 import logging
+import queue
+import threading
 
 import cv2
 import torchvision.transforms as transforms
@@ -7,7 +9,6 @@ from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 from skimage.metrics import peak_signal_noise_ratio as psnr
-from skimage.metrics import structural_similarity as ssim
 
 from datasets import get_dataloader
 from datasets.utils import *
@@ -17,6 +18,33 @@ from utils import get_all_files
 
 __all__ = ['guided_DDIM']
 
+# Boolean disk masks (center (192, 192), radius 165), built once per shape
+_circle_masks = {}
+
+
+def _circle_mask(shape):
+    if shape not in _circle_masks:
+        mask = np.zeros(shape, dtype=np.uint8)
+        cv2.circle(mask, (192, 192), 165, 1, -1)
+        _circle_masks[shape] = mask.astype(bool)
+    return _circle_masks[shape]
+
+
+# annotation font, loaded once per process; missing TTF degrades to PIL default
+_font = None
+
+
+def _get_font():
+    global _font
+    if _font is None:
+        try:
+            _font = ImageFont.truetype(
+                '/content/image_processing_with_python/09_drawing_text/Gidole-Regular.ttf', 16
+            )
+        except OSError:
+            _font = ImageFont.load_default()
+    return _font
+
 
 class guided_DDIM:
     def __init__(self, args, config):
@@ -29,6 +57,12 @@ class guided_DDIM:
         self.ssim_scores = []
         self.psnr_scores = []
 
+        # background writer: JPEG encoding releases the GIL and disk is mostly wait
+        self._io_q = queue.Queue()
+        self._io_error = None
+        self._io_thread = threading.Thread(target=self._drain_io, daemon=True)
+        self._io_thread.start()
+
         os.makedirs(args.log_path, exist_ok=True)
 
     @torch.no_grad()
@@ -58,11 +92,12 @@ class guided_DDIM:
         for idx, X in enumerate(dataloader):
 
             ref, mvue, maps, mask = X['ground_truth'], X['mvue'], X['maps'], X['mask']
-            ref = ref.to(self.device).type(torch.complex128)
-            mvue = mvue.to(self.device)
-            maps = maps.to(self.device)
-            mask = mask.to(self.device)
-            estimated_mvue = torch.tensor(get_mvue(ref.cpu().numpy(), maps.cpu().numpy()), device=self.device)
+            ref = ref.to(self.device, non_blocking=True).type(torch.complex128)
+            mvue = mvue.to(self.device, non_blocking=True)
+            maps = maps.to(self.device, non_blocking=True)
+            mask = mask.to(self.device, non_blocking=True)
+            estimated_mvue = get_mvue_torch(ref, maps)
+            maps_conj = torch.conj(maps).contiguous()
             forward_operator = lambda x: MulticoilForwardMRI(self.args.orientation)(
                 torch.complex(x[:, 0], x[:, 1]),
                 maps, mask)
@@ -71,60 +106,60 @@ class guided_DDIM:
                               self.config.data.channels,
                               self.config.image_size[0],
                               self.config.image_size[1]), device=self.device)
+            noise_buf = torch.empty_like(xt)
 
             for step, (i, j) in enumerate(zip(timesteps, timesteps_next)):
                 if step % log_interval == 0:
                     logging.info(f'Batch: {idx} - Step: {step}')
 
-                t = (torch.ones(self.config.batch_size) * i).to(self.device)
+                t = torch.full((self.config.batch_size,), i, dtype=torch.long, device=self.device)
                 sigma_t = sigmas[i]
                 sigma_t_next = sigmas[j]
 
-                p_grad = score(xt, t.long())
+                p_grad = score(xt, t)
 
                 meas = forward_operator(normalize(xt, estimated_mvue))
-                meas_grad = torch.view_as_real(
-                    torch.sum(ifft(meas - ref) * torch.conj(maps), axis=1)
-                ).permute(0, 3, 1, 2)
+                r = torch.einsum('bchw,bchw->bhw', ifft(meas - ref), maps_conj)
+                meas_grad = torch.stack([r.real, r.imag], dim=1)
                 meas_grad = unnormalize(meas_grad, estimated_mvue)
                 meas_grad = meas_grad.type(torch.cuda.FloatTensor)
-                meas_grad /= torch.norm(meas_grad)
-                meas_grad *= torch.norm(p_grad)
-                meas_grad *= self.config.sampling.mse
+                scale = self.config.sampling.mse * (
+                        torch.linalg.vector_norm(p_grad) / torch.linalg.vector_norm(meas_grad))
+                meas_grad = meas_grad * scale
 
                 s = p_grad - meas_grad
                 coeff = sigma_t / (1 + sigma_t ** 2).sqrt()
                 xt = (xt + coeff * (sigma_t - sigma_t_next) * s).type(torch.cuda.FloatTensor)
 
                 # corrector steps
+                labels = torch.full((xt.shape[0],), j, dtype=torch.long, device=xt.device)
                 for _ in range(self.config.corrector_steps):
                     step_size = self.config.sampling.step_lr * (sigmas_np[i] / sigmas_np[-1]) ** 2
-                    noise = torch.randn_like(xt) * np.sqrt(step_size * 2)
-                    labels = (torch.ones(xt.shape[0], device=xt.device) * j).long()
+                    noise = noise_buf.normal_().mul_(np.sqrt(step_size * 2))
                     p_grad = score(xt, labels)
 
                     meas = forward_operator(normalize(xt, estimated_mvue))
-                    meas_grad = torch.view_as_real(
-                        torch.sum(ifft(meas - ref) * torch.conj(maps), axis=1)).permute(0, 3, 1, 2)
+                    r = torch.einsum('bchw,bchw->bhw', ifft(meas - ref), maps_conj)
+                    meas_grad = torch.stack([r.real, r.imag], dim=1)
                     meas_grad = unnormalize(meas_grad, estimated_mvue)
                     meas_grad = meas_grad.type(torch.cuda.FloatTensor)
-                    meas_grad /= torch.norm(meas_grad)
-                    meas_grad *= torch.norm(p_grad)
-                    meas_grad *= self.config.sampling.mse
+                    scale = self.config.sampling.mse * (
+                            torch.linalg.vector_norm(p_grad) / torch.linalg.vector_norm(meas_grad))
+                    meas_grad = meas_grad * scale
 
                     xt = xt + step_size * (p_grad - meas_grad) + noise
 
             # denoising step
-            t_last = (torch.ones(self.config.batch_size) * (diffusion_timesteps - 1)).to(self.device)
-            p_grad = score(xt, t_last.long())
+            t_last = torch.full((self.config.batch_size,), diffusion_timesteps - 1, dtype=torch.long,
+                                device=self.device)
+            p_grad = score(xt, t_last)
             meas = forward_operator(normalize(xt, estimated_mvue))
-            meas_grad = torch.view_as_real(
-                torch.sum(ifft(meas - ref) * torch.conj(maps), axis=1)
-            ).permute(0, 3, 1, 2)
+            r = torch.einsum('bchw,bchw->bhw', ifft(meas - ref), maps_conj)
+            meas_grad = torch.stack([r.real, r.imag], dim=1)
             meas_grad = unnormalize(meas_grad, estimated_mvue).type(torch.cuda.FloatTensor)
-            meas_grad /= torch.norm(meas_grad)
-            meas_grad *= torch.norm(p_grad)
-            meas_grad *= self.config.sampling.mse
+            scale = self.config.sampling.mse * (
+                    torch.linalg.vector_norm(p_grad) / torch.linalg.vector_norm(meas_grad))
+            meas_grad = meas_grad * scale
 
             s = p_grad - meas_grad
             H = xt + sigmas[-2] ** 2 * s
@@ -137,16 +172,19 @@ class guided_DDIM:
                                                    self.config.data.channels).contiguous()
             ).abs().flip(-2)
 
+            slices = []
             for i in range(self.config.batch_size):
-
-                slice_idx = X["slice_idx"][i].item()
-                file_name = os.path.join(self.args.log_path, f'{self.config.anatomy}_{slice_idx}.jpg')
-
                 recon_img = to_display[i].unsqueeze(dim=0)
                 orig_img = mvue[i].abs().flip(-2)
 
                 orig_th, recon_th, orig_np, recon_np = self.edit(self.config, orig_img, recon_img)
-                ssim_score = ssim(orig_np, recon_np)
+                slices.append((orig_th, orig_np, recon_np, X["slice_idx"][i].item()))
+
+            # one vectorized SSIM pass over the whole batch
+            ssim_batch = batched_ssim(np.stack([s[1] for s in slices]),
+                                      np.stack([s[2] for s in slices]))
+
+            for (orig_th, orig_np, recon_np, slice_idx), ssim_score in zip(slices, ssim_batch):
                 psnr_score = psnr(orig_np, recon_np)
                 self.ssim_scores.append(ssim_score)
                 self.psnr_scores.append(psnr_score)
@@ -154,39 +192,52 @@ class guided_DDIM:
                 if self.args.save_images:
 
                     file_name = os.path.join(self.args.log_path, f'{self.config.anatomy}_{slice_idx}_or.jpg')
-                    save_images(orig_th, file_name, normalize=True)
+                    self._io_q.put((orig_th.cpu(), file_name))
 
                     recon_np = Image.fromarray(recon_np)
                     draw = ImageDraw.Draw(recon_np)
-                    font = ImageFont.truetype(
-                        '/content/image_processing_with_python/09_drawing_text/Gidole-Regular.ttf', 16
-                        )
+                    font = _get_font()
                     draw.text((175, 360), "SSIM: {:0.2f}".format(ssim_score), 255, font=font)
                     draw.text((265, 360), "PSNR: {:0.2f}(db)".format(psnr_score), 255, font=font)
                     file_name = os.path.join(self.args.log_path, f'{self.config.anatomy}_{slice_idx}.jpg')
-                    recon_np.save(file_name)
+                    self._io_q.put((recon_np, file_name))
+
+        # wait for the writer to flush all queued images
+        self._io_q.join()
+        if self._io_error is not None:
+            raise self._io_error
 
         stats_dict = {'ssim': self.ssim_scores, 'psnr': self.psnr_scores}
         stats_file = os.path.join(self.args.log_path, 'stats.json')
         with open(stats_file, 'w') as f:
             json.dump(stats_dict, f, indent=2)
 
+    def _drain_io(self):
+        while True:
+            image, path = self._io_q.get()
+            try:
+                if isinstance(image, Image.Image):
+                    image.save(path, format='JPEG', quality=90, optimize=False)
+                else:
+                    save_images(image, path, normalize=True)
+            except Exception as e:
+                # surface the failure in sample() after the queue joins
+                self._io_error = e
+            finally:
+                self._io_q.task_done()
+
     def edit(self, config, orig_img, recon_img):
 
         if config.denoise_005:
-            recon_img[recon_img <= 0.05 * torch.max(orig_img)] = 0
-            orig_img[orig_img <= 0.05 * torch.max(orig_img)] = 0
+            thr = 0.05 * torch.max(orig_img)
+            recon_img = torch.where(recon_img <= thr, recon_img.new_zeros(()), recon_img)
+            orig_img = torch.where(orig_img <= thr, orig_img.new_zeros(()), orig_img)
 
-        orig_np = orig_img.squeeze().cpu().numpy()
-        orig_np *= 255.0 / orig_np.max()
-        orig_np = orig_np.astype(np.uint8)
-        recon_np = recon_img.squeeze().cpu().numpy()
-        recon_np *= 255.0 / recon_np.max()
-        recon_np = recon_np.astype(np.uint8)
+        # scale + cast on-device so only uint8 crosses the device->host boundary
+        orig_np = (orig_img / orig_img.max()).mul_(255.0).to(torch.uint8).squeeze().cpu().numpy()
+        recon_np = (recon_img / recon_img.max()).mul_(255.0).to(torch.uint8).squeeze().cpu().numpy()
 
         if config.circle_mask:
-            mask = np.zeros(recon_np.shape, dtype=np.uint8)
-            cv2.circle(mask, (192, 192), 165, 255, -1)
-            recon_np = cv2.bitwise_and(recon_np, recon_np, mask=mask)
+            recon_np[~_circle_mask(recon_np.shape)] = 0
 
         return orig_img, recon_img, orig_np, recon_np